@@ -2,12 +2,17 @@
     Log Django debug pages.
 
     Copyright 2010-2020 DeNova
-    Last modified: 2021-05-18
+    Last modified: 2026-10-14
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
 
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+from queue import Queue
 from tempfile import NamedTemporaryFile
+from threading import Lock
 
 try:
     from django.utils.deprecation import MiddlewareMixin
@@ -19,7 +24,79 @@ from denova.django_addons.utils import is_django_error_page
 from denova.python.format import pretty
 from denova.python.log import Log
 
-log = Log()
+_log = Log()
+
+class _LogHandler(logging.Handler):
+    ''' Write queued log records to the denova log. '''
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.levelno >= logging.ERROR:
+            _log.error(message)
+        elif record.levelno >= logging.WARNING:
+            _log.warning(message)
+        elif record.levelno >= logging.INFO:
+            _log(message)
+        else:
+            _log.debug(message)
+
+# Each Log() message is a separate write to the log server.
+# Requests only queue log records. A background thread writes them.
+# The thread starts on first use, and again in each forked child,
+# because fork() does not copy threads.
+_log_listener = None
+_log_listener_lock = Lock()
+
+class _QueueHandler(QueueHandler):
+    ''' Queue log records, and start the writer thread if needed. '''
+
+    def enqueue(self, record):
+        if _log_listener is None:
+            _start_log_listener()
+        super().enqueue(record)
+
+_log_handler = _QueueHandler(Queue(-1))
+
+def _start_log_listener():
+    ''' Start the background thread that writes queued log records. '''
+
+    global _log_listener
+
+    with _log_listener_lock:
+        if _log_listener is None:
+            _log_listener = QueueListener(_log_handler.queue, _LogHandler())
+            _log_listener.start()
+
+@atexit.register
+def _stop_log_listener():
+    ''' Write any records still in the queue, then stop the thread. '''
+
+    global _log_listener
+
+    with _log_listener_lock:
+        if _log_listener is not None:
+            _log_listener.stop()
+            _log_listener = None
+
+def _reset_log_listener_in_child():
+    ''' Forget the parent's writer thread, which the child does not have. '''
+
+    global _log_listener, _log_listener_lock
+
+    # the parent's thread may have held these locks during fork()
+    _log_listener_lock = Lock()
+    _log_handler.queue = Queue(-1)
+    _log_listener = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_log_listener_in_child)
+
+log = logging.getLogger(__name__)
+log.addHandler(_log_handler)
+# error pages are always reported. A LOGGING entry for
+# this module can still change the level, e.g. to DEBUG.
+log.setLevel(logging.INFO)
+log.propagate = False
 
 
 class DebugMiddleware(MiddlewareMixin):
@@ -28,36 +105,69 @@ class DebugMiddleware(MiddlewareMixin):
         Logs Django debug pages and says it's an error. '''
 
     def process_exception(self, request, exception):
-        log('process_response()')
+        log.info('process_response()')
         # request does not include a kwarg named PATH
-        log(f'request: {request}')
-        log(exception)
+        log.info('request: %s', request)
+        # the traceback is formatted now, before the record is queued
+        log.exception(exception)
 
     def process_response(self, request, response):
+        '''
+            Log error responses.
+
+            >>> from logging.handlers import BufferingHandler
+            >>> from django.http import HttpResponse
+            >>> from django.test import RequestFactory
+            >>> request = RequestFactory().get('/')
+            >>> content = (b"You're seeing this error because you have ... " +
+            ...            b'display a standard 500 page')
+            >>> response = HttpResponse(content, status=500)
+            >>> handler = BufferingHandler(100)
+            >>> log.addHandler(handler)
+            >>> DebugMiddleware(lambda request: response).process_response(request, response) is response
+            True
+            >>> log.removeHandler(handler)
+            >>> [path] = [record.args[0] for record in handler.buffer
+            ...           if 'django debug page' in record.msg]
+            >>> os.remove(path)
+        '''
 
         def log_why(why):
-            log(why)
-            log(f'request: {request!r}')
-            log.debug(f'    headers:\n{pretty(request.META)}')
-            log.debug(f'    data: {repr(request.POST)}')
-            log(f'response: {response!r}')
-
-        log('process_response()')
-        log(f'request: {request}')
-        log(f'response.status_code: {response.status_code:d}')
-        log(f'response: {response}')
+            log.info(why)
+            log.info('request: %r', request)
+            # pretty() is slow, so only call it if the record is used
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('    headers:\n%s', pretty(request.META))
+                log.debug('    data: %r', request.POST)
+            log.info('response: %r', response)
+
+        # the per-response trace is only logged at DEBUG level, and
+        # the arguments are only formatted if a record is emitted
+        log.debug('process_response()')
+        log.debug('request: %s', request)
+        log.debug('response.status_code: %d', response.status_code)
+        log.debug('response: %s', response)
+
+        # successful responses and redirects are never error pages,
+        # so don't touch their content
+        if 200 <= response.status_code < 400:
+            return response
 
         try:
-            if is_django_error_page(response.content):
+            # django's debug page for app errors is always a 500,
+            # so don't scan the content of other error responses
+            if (response.status_code >= 500 and
+                is_django_error_page(response.content)):
+
                 with NamedTemporaryFile(
                     prefix='django.debug.page.', suffix='.html',
                     delete=False) as htmlfile:
                     htmlfile.write(response.content)
                 os.chmod(htmlfile.name, 0o644)
-                log(f'django app error: django debug page at {htmlfile.name}')
+                log.info('django app error: django debug page at %s', htmlfile.name)
 
             elif response.status_code == 403:
-                log.warning(f'http error {response.status_code}: missing csrf token?')
+                log.warning('http error %d: missing csrf token?', response.status_code)
                 log_why(f'http error {response.status_code}')
 
             elif response.status_code >= 400:
@@ -65,6 +175,6 @@ class DebugMiddleware(MiddlewareMixin):
                 #log.stacktrace()
 
         except AttributeError as ae:
-            log(f'ignored in denova.django_addons.middleware.DebugMiddleware.process_response(): {ae}')
+            log.info('ignored in denova.django_addons.middleware.DebugMiddleware.process_response(): %s', ae)
 
         return response
@@ -2,11 +2,12 @@
     Get and save a singleton record.
 
     Copyright 2015-2021 DeNova
-    Last modified: 2021-06-17
+    Last modified: 2026-10-14
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
 
+import random
 from time import sleep
 from traceback import format_exc
 
@@ -21,6 +22,9 @@ from denova.python.log import Log
 
 log = Log()
 
+# seconds
+MAX_RETRY_DELAY = 0.5
+
 def get_singleton(model, db=None):
     '''
         Get a singleton record.
@@ -44,14 +48,13 @@ def get_singleton(model, db=None):
         else:
             records = model.objects.using(db).all()
 
-        if records.count() == 1:
-            for r in records:
-                record = r
-        elif records.count() > 1:
-            for r in records:
-                if record is None:
-                    record = r
-                else:
+        # fetching at most 2 records tells us if there are extras
+        # without any COUNT queries
+        rows = list(records[:2])
+        if rows:
+            record = rows[0]
+            if len(rows) > 1:
+                for r in records.exclude(pk=record.pk):
                     log(f'deleted extra record: {r.pk}')
                     r.delete()
 
@@ -62,10 +65,14 @@ def get_singleton(model, db=None):
     return record
 
 
-def save_singleton(model, record, db=None, maxtries=3):
+def save_singleton(model, record, db=None, maxtries=3, verify=False):
     '''
         Save a singleton record.
 
+        If verify=True, also check that there is only one record
+        and delete any extras. Not needed if the table has a
+        uniqueness constraint.
+
         >>> from django.contrib.auth.models import Group
         >>> records = Group.objects.all()
         >>> for record in records:
@@ -81,10 +88,12 @@ def save_singleton(model, record, db=None, maxtries=3):
         try:
             record.save(using=using)
 
-        except:
+        except OperationalError:
             log.exception_only()
 
             retries = maxtries - 1
+            # the first backoff is 10-50 ms, doubling each retry
+            attempt = 0
             retrying = True
             while retrying:
                 retries = retries - 1
@@ -93,7 +102,11 @@ def save_singleton(model, record, db=None, maxtries=3):
 
                 except OperationalError:
                     if retries > 0:
-                        sleep(1)
+                        # exponential backoff with jitter so
+                        # contending writers don't retry in lockstep
+                        delay = random.uniform(0.01, 0.05) * (2 ** attempt)
+                        sleep(min(delay, MAX_RETRY_DELAY))
+                        attempt = attempt + 1
                     else:
                         log('save_singleton(): too many retries')
                         raise
@@ -105,8 +118,9 @@ def save_singleton(model, record, db=None, maxtries=3):
         with transaction.atomic():
             save(using=db)
 
-        # get the singleton again to insure there's only 1 record
-        get_singleton(model, db=db)
+            if verify:
+                # get the singleton again to insure there's only 1 record
+                get_singleton(model, db=db)
     except Exception:
         log(f'tried to save {model}')
         log(format_exc())
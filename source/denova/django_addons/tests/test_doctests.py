@@ -6,7 +6,7 @@
     maintained so have been disabled.
 
     Copyright 2019-2021 DeNova
-    Last modified: 2021-02-22
+    Last modified: 2026-10-14
 '''
 
 import sys
@@ -14,6 +14,7 @@ from doctest import testmod
 from unittest import main, TestCase
 
 import denova.django_addons.data_image
+import denova.django_addons.middleware.debug
 import denova.django_addons.singleton
 import denova.django_addons.utils
 import denova.django_addons.views
@@ -27,6 +28,12 @@ class TestDoctests(TestCase):
         test_result = testmod(denova.django_addons.data_image, report=True)
         self.assertEqual(test_result[0], 0)
 
+    def test_middleware_debug(self):
+        ''' Test debug middleware doctests. '''
+
+        test_result = testmod(denova.django_addons.middleware.debug, report=True)
+        self.assertEqual(test_result[0], 0)
+
     def test_singleton(self):
         ''' Test singleton doctests. '''
 
@@ -3,7 +3,7 @@
     html_addons is named to avoid conflict with python's html pacakge.
 
     Copyright 2013-2021 DeNova
-    Last modified: 2021-06-22
+    Last modified: 2026-10-14
 
     Requires BeautifulSoup, html5lib, and lxml for proper pretty printing of HTML.
 
@@ -16,8 +16,65 @@ import re
 from denova.python.format import to_bytes, to_string
 from denova.python.log import Log
 
+# optional parsers are checked once, at import
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    from bs4 import BeautifulSoup, FeatureNotFound
+except ImportError:
+    BeautifulSoup = None
+
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    etree = None
+    lxml_html = None
+
 log = Log()
 
+# text in these tags is not visible on the page
+INVISIBLE_TAGS = {'style', 'script', 'head', 'title'}
+_VISIBLE_TEXT_XPATH = '//*[not(self::style or self::script or self::head or self::title)]/text()'
+
+# compile regular expressions once, not on every call
+_DOCTYPE_RE = re.compile(r'<!\s*DOCTYPE.*?>', re.IGNORECASE)
+_CDATA_RE = re.compile(r'<\s*!\s*\[\s*CDATA\s*\[(.*?)\s*]\s*]>', re.IGNORECASE)
+_WS_TAGS_RE = re.compile(r'>[\s\n\t]+<')
+_WS_TAGS_OR_WS_RE = re.compile(r'(>\s+<)|(\s+)')
+_TAG_RE = re.compile(r'<.*?>')
+_XML_ENC_RE = re.compile(rb'encoding\s*=\s*[\"\'](.+?)[\"\']', re.IGNORECASE)
+_TITLE_RE = re.compile(rb'''<\s* title .*?>
+                            (.*?)
+                        <\s*/\s* title \s*>
+                     ''',
+                     re.VERBOSE | re.DOTALL | re.IGNORECASE)
+_HIDDEN_TAG_RE = re.compile(r'&(lt|gt);')
+_HIDDEN_TAG_BYTES_RE = re.compile(rb'&(lt|gt);')
+_HIDDEN_TAGS = {'lt': '<', 'gt': '>'}
+_HIDDEN_TAGS_BYTES = {b'lt': b'<', b'gt': b'>'}
+
+def _lxml_parse(parse, markup):
+    ''' Parse markup with an lxml.html function such as fromstring().
+
+        lxml refuses a str with an xml encoding declaration. A str is
+        already decoded, so the declaration is stale. Parse the str
+        as utf-8 bytes and ignore the declaration.
+    '''
+
+    try:
+        root = parse(markup)
+    except ValueError:
+        if not isinstance(markup, str):
+            raise
+        parser = lxml_html.HTMLParser(encoding='utf-8')
+        root = parse(markup.encode(), parser=parser)
+
+    return root
+
 class LinkParser(HTMLParser):
     ''' Generic link parser.
 
@@ -100,7 +157,17 @@ class LinkParser(HTMLParser):
 def extract_text(html):
     ''' Extract plain text from html.
 
-        Prefers BeautifulSoup 4, but falls back to ad hoc extraction.
+        Prefers selectolax, then lxml, but falls back to ad hoc extraction.
+
+        >>> text = extract_text('<?xml version="1.0" encoding="utf-8"?><p>hello</p>')
+        >>> 'hello' in text
+        True
+
+        Bytes are decoded first, so lxml doesn't guess latin-1.
+
+            >>> text = extract_text('<html><body><p>bytes é</p></body></html>'.encode())
+            >>> 'bytes é' in text
+            True
 
         >>> from denova.net.utils import get_page
         >>> page = get_page('https://denova.com')
@@ -113,13 +180,38 @@ def extract_text(html):
         True
     '''
 
-    try:
-        from bs4 import BeautifulSoup
+    # without a meta charset, libxml2 decodes bytes as latin-1
+    html = to_string(html)
+
+    if LexborHTMLParser is not None:
+        # selectolax's lexbor parser is much faster than BeautifulSoup
+        texts = []
+        tree = LexborHTMLParser(html)
+        if tree.body is not None:
+            for node in tree.body.traverse(include_text=True):
+                if (node.tag == '-text' and
+                    node.parent.tag not in INVISIBLE_TAGS):
+
+                    texts.append(node.text_content)
+
+        text = '\n'.join(texts)
+
+    elif lxml_html is not None:
+        # the xpath filter runs in C, and text() skips comments
+        try:
+            root = _lxml_parse(lxml_html.fromstring, html)
+        except etree.ParserError:
+            # empty document
+            texts = []
+        else:
+            texts = root.xpath(_VISIBLE_TEXT_XPATH)
+
+        text = '\n'.join(texts)
 
-    except ImportError:
+    else:
         # ad hoc
         #log.debug(f'html: {repr(html)}')
-        text = re.sub(r'<.*?>', ' ', html.strip())
+        text = _TAG_RE.sub(' ', html.strip())
         #log.debug(f'text after re: {text}')
         text = text.replace('  ', ' ')
         # some html tags are still present; overlapping regex matches?
@@ -127,23 +219,6 @@ def extract_text(html):
         text, _, _ = text.partition('<')
         #log.debug(f'final text: {text}')
 
-    else:
-        # BeautifulSoup
-        # from http://stackoverflow.com/questions/1936466/beautifulsoup-grab-visible-webpage-text
-        soup = BeautifulSoup(html, features='lxml')
-        texts = soup.findAll(text=True)
-
-        def visible(element):
-            if element.parent.name in ['style', 'script', '[document]', 'head', 'title']:
-                return False
-            elif re.match('<!--.*-->', str(element)):
-                return False
-            return True
-
-        visible_texts = list(filter(visible, texts))
-
-        text = '\n'.join(visible_texts)
-
     return text
 
 def get_links(htmlpath, exclude=None):
@@ -159,81 +234,116 @@ def get_links(htmlpath, exclude=None):
         Example: To exclude links to google, use "exclude='google'".
 
         Very ad hoc.
+
+        >>> from tempfile import NamedTemporaryFile
+        >>> html = ('<p><a href="https://xyz.com/">café</a> '
+        ...         '<a href="https://abc.com/">abc</a> <a href="/local">local</a></p>')
+        >>> with NamedTemporaryFile(suffix='.html') as htmlfile:
+        ...     _ = htmlfile.write(html.encode())
+        ...     htmlfile.flush()
+        ...     links = get_links(htmlfile.name)
+        ...     excluded = get_links(htmlfile.name, exclude='x')
+        >>> [[url, summary] for _, url, summary in links]
+        [['https://xyz.com/', 'café'], ['https://abc.com/', 'abc']]
+        >>> [url for _, url, _ in excluded]
+        ['https://abc.com/']
     '''
 
-    # fallable importdelayed until needed
-    try:
-        from pyquery.pyquery import PyQuery
+    if lxml_html is None:
+        raise Exception('lxml not installed')
 
-    except ModuleNotFoundError:
-        raise Exception('pyquery not installed')
+    results = []
 
-    else:
+    # without a meta charset, libxml2 decodes bytes as latin-1
+    with open(htmlpath, 'rb') as infile:
 
-        results = []
+        html = _lxml_parse(lxml_html.fromstring, to_string(infile.read()))
+        # the xpath filter runs in C
+        for anchor in html.xpath('//a[starts-with(@href, "http")]'):
+            href = anchor.get('href')
+            if not exclude or (exclude not in href):
+                text = anchor.text_content() or ''
+                results.append([htmlpath, href, text.strip()])
+                # log.debug(f'\t{href}') # DEBUG
 
-        with open(htmlpath) as infile:
+    return results
 
-            html = PyQuery(to_bytes(infile.read()))
-            anchor_tags = html.items('a')
-            # log.debug(f'{len(list(anchor_tags))} links: {htmlpath}') # DEBUG
-            for item in anchor_tags:
-                href = item.attr('href')
-                if href and href.startswith('http'):
-                    if exclude and (exclude not in href):
-                        results.append([htmlpath, href, item.text().strip()])
-                        # log.debug(f'\t{href}') # DEBUG
+def expose_hidden_tags(html):
+    ''' Make spoofed tags explicit.
 
-        return results
+        >>> expose_hidden_tags('&lt;b&gt;bold&lt;/b&gt;')
+        '<b>bold</b>'
 
-def expose_hidden_tags(html):
-    ''' Make spoofed tags explicit. '''
+        >>> expose_hidden_tags(b'&lt;b&gt;bold&lt;/b&gt;')
+        b'<b>bold</b>'
+    '''
 
     # this may not work with some cases. Example:
     #     <description>&lt; . . . &gt;</description>
     # a possible workaround is to re-encode these cases of '<' and '>' after firewalling
 
+    # one pass over the html instead of one pass per hidden tag
     if isinstance(html, str):
-        start_tag = '<'
-        end_tag = '>'
-        hidden_start_tag = '&lt;'
-        hidden_end_tag = '&gt;'
+        html = _HIDDEN_TAG_RE.sub(lambda match: _HIDDEN_TAGS[match.group(1)], html)
     elif isinstance(html, bytes):
-        start_tag = b'<'
-        end_tag = b'>'
-        hidden_start_tag = b'&lt;'
-        hidden_end_tag = b'&gt;'
+        html = _HIDDEN_TAG_BYTES_RE.sub(lambda match: _HIDDEN_TAGS_BYTES[match.group(1)], html)
     else:
         raise ValueError('html must be a string or bytes')
 
-    if hidden_start_tag in html:
-        #log.warning(f'exposing {str(hidden_start_tag)} in html')
-        html = html.replace(hidden_start_tag, start_tag)
-    if hidden_end_tag in html:
-        #log.warning(f'exposing {str(hidden_end_tag)} in html')
-        html = html.replace(hidden_end_tag, end_tag)
-
     return html
 
 def clean_xml(xml):
     ''' Return (more) valid xml. Html is xml, so clean_xml() also cleans html.
 
+        Prefers lxml, which parses and prettyprints in C.
+
         BeautifulSoup has a rep for accepting bad xml.
-        Then it can write good xml.
+        Then it can write good xml. If lxml is not installed
+        or can't parse the xml, we use BeautifulSoup.
+
+        >>> cleaned = clean_xml('<?xml version="1.0" encoding="utf-8"?><p>hello</p>')
+        >>> 'hello' in cleaned
+        True
+
+        The result is well formed xml, even with html void elements.
+
+            >>> cleaned = clean_xml('<item><p>a<br>b</p><link>http://x</link></item>')
+            >>> etree.fromstring(cleaned).tag
+            'html'
     '''
 
-    try:
-        from bs4 import BeautifulSoup
-    except ImportError:
-        log('BeautifulSoup not installed so xml cannot be cleaned.')
-        raise
-    else:
+    cleaned_xml = None
+
+    if lxml_html is not None:
         try:
-            soup = BeautifulSoup(xml, features='html5lib')
-        except:  # 'bare except' because it catches more than "except Exception"
-            # "features='lxml'" is to silence a very noisy and useless
-            # error message from BeautifulSoup
+            root = _lxml_parse(lxml_html.document_fromstring, xml)
+        except (etree.ParserError, etree.XMLSyntaxError):
+            log.debug('lxml could not parse xml, so trying BeautifulSoup')
+        else:
+            # the html serializer neither indents nor closes void
+            # elements such as <br>, so write xml
+            etree.indent(root)
+            cleaned_xml = etree.tostring(root, pretty_print=True,
+                                         method='xml', encoding='unicode')
+
+    if cleaned_xml is None:
+        if BeautifulSoup is None:
+            log('BeautifulSoup not installed so xml cannot be cleaned.')
+            raise ImportError('BeautifulSoup not installed')
+
+        if etree is None:
+            parse_errors = (FeatureNotFound,)
+        else:
+            parse_errors = (FeatureNotFound, etree.XMLSyntaxError)
+
+        try:
+            # lxml is much faster than html5lib, so only use
+            # html5lib when lxml is not available or fails.
+            # An explicit "features=" also silences a very noisy
+            # and useless error message from BeautifulSoup
             soup = BeautifulSoup(xml, features='lxml')
+        except parse_errors:
+            soup = BeautifulSoup(xml, features='html5lib')
 
         cleaned_xml = soup.prettify()
 
@@ -260,65 +370,60 @@ def remove_doctype(html):
         appears to be overkill.
     '''
 
-    DOCTYPE = r'\<!\s*DOCTYPE.*?\>'
-    return re.sub(DOCTYPE, '', html, flags=re.IGNORECASE)
+    return _DOCTYPE_RE.sub('', html)
 
 def find_tags(elements, tags, matches=None):
-    ''' Find all matching tags in xmltodict elements. '''
-
-    DEBUG = True
+    ''' Find all matching tags in xmltodict elements.
+
+        >>> elements = {'rss': {'channel': {'item': [{'title': 'one'}, {'title': 'two'}]}}}
+        >>> find_tags(elements, 'title')
+        ['one', 'two']
+        >>> find_tags(elements, 'item')
+        [{'title': 'one'}, {'title': 'two'}]
+        >>> find_tags({'a': {'title': 'one'}, 'title': 'two'}, ['title'])
+        ['one', 'two']
+    '''
 
-    def debug(msg):
-        if DEBUG:
-            log(f'find_tags: {msg}')
+    # messages are only built if DEBUG is True
+    DEBUG = False
 
     def find_matches(elements, tags, matches):
-        ''' Elements can have keys that are dicts,
-            so handle regular keys and the fancier ones. '''
+        ''' Elements can have values that are dicts or lists,
+            so walk them depth first in document order. An explicit
+            stack of iterators avoids a python call per element.
+
+            Matches are appended to 'matches' in place.
+        '''
 
-        for key in elements:
+        # local names are faster than builtins
+        _dict = dict
+        _list = list
+        _isinstance = isinstance
+        append = matches.append
+        extend = matches.extend
 
-            if isinstance(key, dict):
-                matches = find_matches(key, tags, matches)
+        def children(node):
+            if _isinstance(node, _dict):
+                return iter(node.items())
             else:
-                debug(f'subkey: {key}') # DEBUG
-                value = elements[key]
+                # list items have no key to match
+                return ((None, item) for item in node)
 
+        stack = [children(elements)]
+        while stack:
+            for key, value in stack[-1]:
                 if key in tags:
-                    debug(f'subkey matches tag: {key}') # DEBUG
-                    if isinstance(value, list):
-                        for v in value:
-                            matches.append(v)
+                    if _isinstance(value, _list):
+                        extend(value)
                     else:
-                        matches.append(value)
-
-                else:
-                    if isinstance(value, dict):
-                        debug('recursing') # DEBUG
-                        matches = matches + find_tags(value, tags, matches)
-                        debug('back from recursion') # DEBUG
-
-                        # xmltodict.unparse(value, pretty=True)
-                        keys = []
-                        for subkey in value:
-                            keys.append(subkey)
-                        if keys:
-                            debug(f'subkeys for "{key}":\n{keys}')
-
-                    elif isinstance(value, str):
-                        debug(f'subkey value: "{value}"')
-
-                    elif isinstance(value, list):
-                        for item in value:
-                            debug('recursing') # DEBUG
-                            matches = matches + find_tags(value, tags, matches)
-                            debug('back from recursion') # DEBUG
+                        append(value)
 
-                    else:
-                        debug(f'subkey value type: {type(value)}')
-                        debug(f'subkey value: {repr(value)}')
+                elif _isinstance(value, (_dict, _list)):
+                    stack.append(children(value))
+                    break
 
-        return matches
+            else:
+                stack.pop()
 
 
     # if single tag, make it a sequence
@@ -326,18 +431,18 @@ def find_tags(elements, tags, matches=None):
         tags = [tags]
 
     # lower case tags
-    tags = [tag.lower() for tag in tags]
+    tags = frozenset(tag.lower() for tag in tags)
 
-    debug(f'search {elements}') # DEBUG
-    debug(f'find tags matching {tags}') # DEBUG
+    if DEBUG:
+        log(f'find_tags: search {elements}')
+        log(f'find_tags: find tags matching {tags}')
 
-    # if this is the top of the find_tags() recursion chain
     if matches is None:
         matches = []
-    else:
-        debug(f'matches {matches}') # DEBUG
+    elif DEBUG:
+        log(f'find_tags: matches {matches}')
 
-    matches = find_matches(elements, tags, matches)
+    find_matches(elements, tags, matches)
 
     return matches
 
@@ -362,6 +467,20 @@ def decode_html_file(path):
         Sometimes an html/xml file will specify its encoding in
         an xml comment at the top of the file. That's what we
         are trying to handle here.
+
+        >>> from tempfile import NamedTemporaryFile
+        >>> def decode_as(html, encoding):
+        ...     with NamedTemporaryFile(suffix='.html') as htmlfile:
+        ...         _ = htmlfile.write(html.encode(encoding))
+        ...         htmlfile.flush()
+        ...         return decode_html_file(htmlfile.name)
+        >>> decode_as('<?xml version="1.0" encoding="iso-8859-7"?><p>αβγ</p>', 'iso-8859-7')
+        '<p>αβγ</p>'
+
+        If the declared encoding is wrong, common encodings are tried.
+
+            >>> decode_as('<?xml version="1.0" encoding="utf-8"?><p>café</p>', 'latin-1')
+            '<p>café</p>'
     '''
 
     log(f'UnicodeDecodeError: {path}')
@@ -372,22 +491,27 @@ def decode_html_file(path):
         content = infile.read()
 
     log(f'look for xml encoding: {path}')
-    encoding = get_xml_encoding(content)
+    # split off any xml declaration while still bytes,
+    # so we only decode once
+    encoding = None
+    if content.lstrip().startswith(b'<?'):
+        end = content.find(b'?>')
+        if end >= 0:
+            end = end + len(b'?>')
+            xml_declaration, body = content[:end], content[end:]
+            match = _XML_ENC_RE.search(xml_declaration)
+            if match:
+                encoding = match.group(1).decode(errors='replace')
+
     if encoding:
+        # lxml won't accept a string with an encoding declaration,
+        # so only decode what follows the declaration
         try:
-            content = content.decode(encoding)
-        except Exception:
+            content = body.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
             # the declared encoding may be wrong
-            # try the default utf-8
-            # this i
-            content = content.decode()
-
-        # lxml won't accept bytes with an encoding declaration
-        log(f'strip any xml declaration: {path}')
-        if content.strip().startswith('<?'):
-            _, separator, suffix = content.partition('?>')
-            if separator:
-                content = suffix
+            # to_string() tries common encodings
+            content = to_string(body)
 
     else:
         log.warning(f'UnicodeDecodeError, but no encoding specified: {path}')
@@ -409,9 +533,7 @@ def get_xml_encoding(content):
             xml_declaration = prefix + separator
             log.debug(f'xml_declaration: {xml_declaration}')
 
-            match = re.search(rb'encoding\s*=\s*[\"\'](.+?)[\"\']',
-                              xml_declaration,
-                              flags=re.IGNORECASE)
+            match = _XML_ENC_RE.search(xml_declaration)
             if match:
                 encoding = match.group(1)
                 # log.debug(f'{self.name} encoding: {encoding}')
@@ -484,7 +606,13 @@ def get_title(html):
 
     title = None
 
-    if is_html(html):
+    # quick check before parsing the whole document
+    if isinstance(html, bytes):
+        has_title = b'<title' in html.lower()
+    else:
+        has_title = '<title' in html.lower()
+
+    if has_title and is_html(html):
         parser = TitleParser()
         parser.parse(html)
         title = parser.title
@@ -520,17 +648,15 @@ def get_title_using_re(html):
         Test title
     '''
 
-    PATTERN = re.compile(rb'''<\s* title .*?>
-                                  (.*?)
-                              <\s*/\s* title \s*>
-                         ''',
-                         re.VERBOSE | re.DOTALL | re.IGNORECASE)
-
-
     title = None
 
-    if is_html(html):
-        match = PATTERN.search(to_bytes(html))
+    html = to_bytes(html)
+    # quick check before using the regex engine on the whole document
+    start = html.lower().find(b'title')
+    if start >= 0 and is_html(html):
+        # start the search at the '<' before 'title'
+        start = max(html.rfind(b'<', 0, start), 0)
+        match = _TITLE_RE.search(html, start)
         if match:
             title = to_string(match.group(1).strip())
 
@@ -545,14 +671,20 @@ def strip_whitespace_in_html(value, mintext=False):
 
         >>> strip_whitespace_in_html(' <a>   <b> test test2 </b></a>')
         '<a><b> test test2 </b></a>'
+
+        >>> strip_whitespace_in_html(' <a>   <b> test    test2 </b></a>', mintext=True)
+        '<a><b> test test2 </b></a>'
     '''
 
     value = value.strip()
-    # no spaces around tags
-    value = re.sub(r'>[\s\n\t]+<', '><', value)
     if mintext:
+        # in one pass, no spaces around tags and
         # other space sequences replaced by single space
-        value = re.sub(r'\s+', ' ', value)
+        value = _WS_TAGS_OR_WS_RE.sub(
+            lambda match: '><' if match.group(1) else ' ', value)
+    else:
+        # no spaces around tags
+        value = _WS_TAGS_RE.sub('><', value)
 
     return value
 
@@ -561,10 +693,7 @@ def strip_cdata(s):
 
     # Example:
     #     <![CDATA[Text we want to extract]]>
-    return re.sub(r'<\s*!\s*\[\s*CDATA\s*\[(.*?)\s*]\s*]>',
-                  r'\1',
-                  s,
-                  flags=re.IGNORECASE)
+    return _CDATA_RE.sub(r'\1', s)
 
 def is_html(s):
     ''' Return True if likely html, else False.
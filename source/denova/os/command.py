@@ -3,20 +3,72 @@
     Run a command using python subprocess.
 
     Copyright 2018-2020 DeNova
-    Last modified: 2021-05-17
+    Last modified: 2026-10-14
 '''
 
+import atexit
+import codecs
+from functools import cached_property, lru_cache
 from glob import glob
+import io
 import os
 from queue import Queue
+import selectors
 import shlex
 import subprocess
 import sys
+from tempfile import TemporaryFile
 from threading import Thread
 from time import sleep
+from weakref import WeakSet
 
-# log init delayed to avoid circular imports
-log = None
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+# read pipes in big chunks instead of many small reads
+PIPE_BUFSIZE = 65536
+# kernel pipe buffer size
+PIPE_SIZE = 1 << 20
+# from linux fcntl.h; python's fcntl module has it starting in 3.10
+F_SETPIPE_SZ = 1031
+
+# run a command at low priority for both cpu and io
+NICE_PREFIX = ('nice', 'nice', 'ionice', '--class', '3')
+
+# most bytes linux reads from a '#!' line
+SHEBANG_MAX = 256
+
+# run() has always globbed only these, not '['
+_WILDCARDS = frozenset('*?')
+
+# processes started by background()
+_live_processes = WeakSet()
+
+class Result(subprocess.CompletedProcess):
+    ''' A subprocess.CompletedProcess from run().
+
+        The combined .stderrout is only built the first time it is used.
+        Output is often large and stderrout often unused.
+    '''
+
+    @cached_property
+    def stderrout(self):
+        ''' String combining stderr and stdout. '''
+
+        return get_stderrout(self)
+
+@lru_cache(maxsize=1)
+def _log():
+    ''' Return the log for this module.
+
+        The import is delayed to avoid circular imports.
+    '''
+
+    from denova.python.log import Log
+    return Log()
 
 def run(*command_args, **kwargs):
     ''' Run a command line.
@@ -34,8 +86,8 @@ def run(*command_args, **kwargs):
             ...     'invalid time interval' in error.stderrout
             True
 
-        Returns subprocess.CompletedProcess, or raises
-        subprocess.CalledProcessError.
+        Returns a Result, which is a subprocess.CompletedProcess, or
+        raises subprocess.CalledProcessError.
 
         By default run() captures stdout and stderr. It decodes
         .stdout and .stderr, and adds a combined .stderrout.
@@ -43,7 +95,17 @@ def run(*command_args, **kwargs):
         use run_verbose(). This is different from the keyword
         verbose=.
 
-        If verbose is True, run() logs extra information.
+        If verbose is True, run() logs extra information. The
+        command's output is logged as the command runs, once for
+        each chunk read from a pipe.
+
+            >>> result = run('seq', '1', '20000', verbose=True)
+            >>> result.stdout.splitlines()[-1]
+            '20000'
+            >>> run('sleep', '4', input=b'x' * 2000000, verbose=True, timeout=1)
+            Traceback (most recent call last):
+                ...
+            subprocess.TimeoutExpired: Command '['sleep', '4']' timed out after 1 seconds
 
         Each command line arg should be a separate run() arg so
         subprocess.check_output can escape args better.
@@ -56,8 +118,26 @@ def run(*command_args, **kwargs):
 
         Args are globbed unless glob=False.
 
-        Except for 'output_bytes' and 'glob', all keyword args are passed
-        to subprocess.run().
+        If spool=True, captured stdout and stderr are written to
+        temporary files instead of being read from pipes while the
+        command runs. Use this for commands with very large output,
+        so the output is only held in memory once, after the command
+        ends.
+
+            >>> result = run('echo', 'spooled', spool=True)
+            >>> result.stdout
+            'spooled'
+
+        If capture_output=False, run() leaves stdout and stderr alone
+        unless you pass them. Nothing is read or decoded, and
+        .stdout and .stderr are None.
+
+            >>> result = run('true', capture_output=False)
+            >>> result.stdout is None
+            True
+
+        Except for 'output_bytes', 'glob', 'spool', and 'capture_output',
+        all keyword args are passed to subprocess.run().
 
         On error raises subprocess.CalledProcessError.
         The error has an extra data member called 'stderrout' which is a
@@ -72,11 +152,10 @@ def run(*command_args, **kwargs):
                 print(cpe)
                 print(f'error output: {cpe.stderrout}')
 
-        Because we are using PIPEs, to avoid zombie processes we would
-        need to use Popen() instead of subprocess.run(), and call
-        Popen.communicate(). But to get subprocess.run()'s timeout,
-        input and check params, we don't use Popen() for foregroud
-        tasks. Zombie processes are worrisome, but do no real harm.
+        run() uses Popen() and Popen.communicate(), with the same
+        timeout, input and check params as subprocess.run(). The pipes
+        are read in large chunks, and communicate() waits for the
+        child, so there are no zombie processes.
 
         See https://stackoverflow.com/questions/2760652/how-to-kill-or-avoid-zombie-processes-with-subprocess-module
 
@@ -111,46 +190,43 @@ def run(*command_args, **kwargs):
         0
     '''
 
-    _init_log()
+    log = _log()
     result = None
 
-    command_args = list(map(str, command_args))
+    command_args = _ensure_strs(command_args)
 
     try:
         args, kwargs = get_run_args(*command_args, **kwargs)
 
-        if kwargs:
-            if 'verbose' in kwargs:
-                verbose = kwargs['verbose']
-                if verbose:
-                    log(f'args: {args}')
-                    log(f'kwargs: {kwargs}')
-                del kwargs['verbose']
-            else:
-                verbose = False
-        else:
-            verbose = False
+        verbose = kwargs.pop('verbose', False)
+        if verbose:
+            log(f'args: {args}')
+            log(f'kwargs: {kwargs}')
 
-        if 'output_bytes' in kwargs:
-            output_bytes = kwargs['output_bytes']
-            del kwargs['output_bytes']
-            if verbose:
-                log(f'output bytes: {output_bytes}')
-        else:
-            output_bytes = False
+        output_bytes = kwargs.pop('output_bytes', False)
+        if verbose:
+            log(f'output bytes: {output_bytes}')
 
-        for output in ['stdout', 'stderr']:
-            if output not in kwargs:
-                kwargs[output] = subprocess.PIPE
+        spool = kwargs.pop('spool', False)
+
+        # Popen() has no capture_output, so run() handles it here
+        capture_output = kwargs.pop('capture_output', True)
+        if capture_output:
+            for output in ['stdout', 'stderr']:
+                if output not in kwargs:
+                    kwargs[output] = subprocess.PIPE
 
-        result = subprocess.run(args,
-                                check=True,
-                                **kwargs)
+        result = _run_process(args,
+                              check=True,
+                              spool=spool,
+                              # log output as the command runs
+                              log_output=log.debug if verbose else None,
+                              **kwargs)
 
     except subprocess.CalledProcessError as cpe:
         log.warning(f'command got CalledProcessError: {command_args}')
         cpe = format_output(cpe)
-        result = handle_run_error(command_args, cpe)
+        handle_run_error(command_args, cpe)
         raise
 
     except Exception as e:
@@ -163,7 +239,8 @@ def run(*command_args, **kwargs):
         if verbose:
             log(f'command succeeded: {command_args}')
         # log(f'before format_output(result), result: {result}') # DEBUG
-        result = format_output(result)
+        if capture_output and not output_bytes:
+            result = format_output(result)
         # log(f'after format_output(result), result: {result}') # DEBUG
 
     if verbose:
@@ -171,6 +248,293 @@ def run(*command_args, **kwargs):
 
     return result
 
+def _run_process(args, input=None, timeout=None, check=False, spool=False,
+                 log_output=None, **kwargs):
+    ''' Like subprocess.run(), but the pipes use a larger buffer.
+
+        If spool=True, any stdout or stderr PIPE is replaced by a
+        temporary file, which is read after the command ends.
+
+        If log_output is a function, each chunk read from a pipe is
+        passed to it while the command runs.
+
+        Returns a Result, or raises subprocess.CalledProcessError
+        if check=True and the command fails.
+    '''
+
+    if input is not None:
+        if kwargs.get('stdin') is not None:
+            raise ValueError('stdin and input arguments may not both be used.')
+        kwargs['stdin'] = subprocess.PIPE
+
+    kwargs.setdefault('bufsize', PIPE_BUFSIZE)
+
+    # the child writes directly to these files, so
+    # SpooledTemporaryFile would be rolled over to disk anyway
+    spool_files = {}
+    if spool:
+        for output in ['stdout', 'stderr']:
+            if kwargs.get(output) == subprocess.PIPE:
+                spool_files[output] = kwargs[output] = TemporaryFile()
+
+    try:
+        with subprocess.Popen(args, **kwargs) as process:
+            _enlarge_pipes(process)
+            try:
+                if log_output and (process.stdout or process.stderr):
+                    stdout, stderr = _stream_output(process, log_output,
+                                                    input=input, timeout=timeout)
+                else:
+                    stdout, stderr = process.communicate(input=input, timeout=timeout)
+
+            except subprocess.TimeoutExpired as te:
+                process.kill()
+                if not log_output:
+                    te.stdout, te.stderr = process.communicate()
+                raise
+
+            except:  # 'bare except' because it catches more than "except Exception"
+                # Popen.__exit__() waits for the child
+                process.kill()
+                raise
+
+            returncode = process.poll()
+
+        if 'stdout' in spool_files:
+            spool_files['stdout'].seek(0)
+            stdout = spool_files['stdout'].read()
+        if 'stderr' in spool_files:
+            spool_files['stderr'].seek(0)
+            stderr = spool_files['stderr'].read()
+
+    finally:
+        for spool_file in spool_files.values():
+            spool_file.close()
+
+    if check and returncode:
+        raise subprocess.CalledProcessError(returncode, process.args,
+                                            output=stdout, stderr=stderr)
+
+    return Result(process.args, returncode, stdout, stderr)
+
+def _stream_output(process, log_output, input=None, timeout=None):
+    ''' Read stdout and stderr as the process runs.
+
+        Each pipe is read in its own thread, like Popen.communicate()
+        does on Windows, so neither pipe can fill up and block the
+        process. Each chunk read is passed to log_output(), which
+        is usually too slow to call once per line. Input is
+        written from its own thread too, so a large input can't
+        block us past the timeout.
+
+        Returns (stdout, stderr). If the process times out, the
+        subprocess.TimeoutExpired has the output read so far.
+    '''
+
+    def read_pipe(pipe, chunks):
+        # read1() returns whatever is in the pipe, up to PIPE_BUFSIZE,
+        # so output is logged soon after the command writes it
+        if isinstance(pipe, io.TextIOBase):
+            decoder = codecs.getincrementaldecoder(pipe.encoding)(pipe.errors)
+            decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+            reader = pipe.buffer
+        else:
+            decoder = None
+            reader = pipe
+        read = getattr(reader, 'read1', reader.read)
+
+        while True:
+            data = read(PIPE_BUFSIZE)
+            chunk = decoder.decode(data, final=not data) if decoder else data
+            if chunk:
+                chunks.append(chunk)
+                log_output(chunk)
+            if not data:
+                break
+
+        pipe.close()
+
+    def write_pipe(pipe, input):
+        try:
+            if input:
+                pipe.write(input)
+            pipe.close()
+        except BrokenPipeError:
+            # the process doesn't want any more input
+            pass
+
+    def join_chunks(pipe, chunks):
+        if pipe is None:
+            output = None
+        elif isinstance(pipe, io.TextIOBase):
+            output = ''.join(chunks)
+        else:
+            output = b''.join(chunks)
+        return output
+
+    out_chunks = []
+    err_chunks = []
+    threads = []
+    for pipe, chunks in [(process.stdout, out_chunks), (process.stderr, err_chunks)]:
+        if pipe is not None:
+            thread = Thread(target=read_pipe, args=(pipe, chunks), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    if process.stdin:
+        thread = Thread(target=write_pipe, args=(process.stdin, input), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    # the timeout covers writing stdin, because the write is in a thread
+    try:
+        process.wait(timeout=timeout)
+
+    except subprocess.TimeoutExpired as te:
+        process.kill()
+        for thread in threads:
+            thread.join()
+        te.stdout = join_chunks(process.stdout, out_chunks)
+        te.stderr = join_chunks(process.stderr, err_chunks)
+        raise
+
+    for thread in threads:
+        thread.join()
+
+    return join_chunks(process.stdout, out_chunks), join_chunks(process.stderr, err_chunks)
+
+def _enlarge_pipes(process):
+    ''' Enlarge the kernel buffers for any stdout and stderr pipes.
+
+        With the default 64 KiB a command with lots of output blocks
+        until we read the pipe. Popen(pipesize=) needs python 3.10,
+        and raises an error if the kernel refuses the new size. A
+        pipe the kernel won't enlarge still works, so we ignore that.
+    '''
+
+    if fcntl is not None:
+        for pipe in [process.stdout, process.stderr]:
+            if pipe is not None:
+                try:
+                    fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+                except OSError:
+                    pass
+
+def run_many(commands, max_parallel=None, **kwargs):
+    ''' Run many commands at the same time.
+
+        'commands' is a list of commands. Each command is a list of
+        args, the same as the args to run().
+
+        Up to 'max_parallel' commands run at once. The default is the
+        number of cpus. One selector reads the output of every running
+        command, so there is no thread per command.
+
+        Except for 'glob', keyword args are passed to subprocess.Popen()
+        for every command. Stdout and stderr are always captured, so
+        'stdout', 'stderr', and 'interactive=True' raise ValueError.
+        If a command can't be started, the commands already started
+        are killed.
+
+        Returns a list of Result in the same order
+        as the commands, with the output formatted as run() does.
+        Unlike run(), run_many() does not raise CalledProcessError,
+        so check each result's returncode.
+
+        >>> commands = [['echo', 'one'], ['echo', 'two'], ['sh', '-c', 'exit 3']]
+        >>> results = run_many(commands, max_parallel=2)
+        >>> [result.stdout for result in results]
+        ['one', 'two', '']
+        >>> [result.returncode for result in results]
+        [0, 0, 3]
+
+        >>> run_many([['echo', 'one']], stdout=None)
+        Traceback (most recent call last):
+            ...
+        ValueError: run_many() always captures stdout and stderr
+    '''
+
+    def start_next():
+        ''' Start the next command. Return False if there are none left. '''
+
+        started = False
+
+        next_command = next(pending, None)
+        if next_command is not None:
+            index, command = next_command
+            args, popen_kwargs = get_run_args(*command, **dict(kwargs))
+            process = subprocess.Popen(args,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       **popen_kwargs)
+            _enlarge_pipes(process)
+
+            outputs = {}
+            for pipe in [process.stdout, process.stderr]:
+                os.set_blocking(pipe.fileno(), False)
+                selector.register(pipe, selectors.EVENT_READ, (process, index))
+                outputs[pipe] = bytearray()
+            running[process] = outputs
+            open_pipes[process] = len(outputs)
+
+            started = True
+
+        return started
+
+    def finish(process, index):
+        ''' Save the result of a command whose pipes are both closed. '''
+
+        outputs = running.pop(process)
+        del open_pipes[process]
+
+        returncode = process.wait()
+        result = Result(process.args, returncode,
+                        bytes(outputs[process.stdout]),
+                        bytes(outputs[process.stderr]))
+        results[index] = format_output(result)
+
+    if ('stdout' in kwargs or 'stderr' in kwargs or
+        kwargs.get('interactive', False)):
+
+        raise ValueError('run_many() always captures stdout and stderr')
+
+    max_parallel = max_parallel or os.cpu_count() or 1
+
+    results = [None] * len(commands)
+    pending = iter(enumerate(commands))
+    running = {}
+    open_pipes = {}
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            while len(running) < max_parallel and start_next():
+                pass
+
+            while running:
+                for key, _ in selector.select():
+                    process, index = key.data
+                    data = os.read(key.fd, PIPE_BUFSIZE)
+                    if data:
+                        running[process][key.fileobj].extend(data)
+
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        open_pipes[process] = open_pipes[process] - 1
+                        if not open_pipes[process]:
+                            finish(process, index)
+                            start_next()
+
+        finally:
+            # after an error, don't leave any commands running
+            for process in running:
+                process.kill()
+                process.stdout.close()
+                process.stderr.close()
+                process.wait()
+
+    return results
+
 def run_verbose(*args, **kwargs):
     ''' Run program with stdout and stderr directed to
         sys.stdout and sys.stderr.
@@ -204,10 +568,20 @@ def run_verbose(*args, **kwargs):
 def background(*command_args, **kwargs):
     ''' Run a command line in background.
 
-        If your command file is not executable and starts with '#!',
-        background() will use 'shell=True'.
+        If your command file can't be executed directly and starts
+        with '#!', background() runs the '#!' interpreter with your
+        command file.
+
+        Each command line arg should be a separate background() arg,
+        as with run(). To run a single command line string, use
+        split=True and it will be split like a shell would.
 
-        Passes along all keywords to subprocess.Popen().
+            >>> program = background('sleep 0.1', split=True)
+            >>> program.args
+            ['sleep', '0.1']
+            >>> wait_child(program)
+
+        Except for 'split', passes along all keywords to subprocess.Popen().
         That means you can force the subprocess to run in the foreground
         with e.g. timeout= or check=. But command.run() is a better
         choice for this case.
@@ -230,7 +604,9 @@ def background(*command_args, **kwargs):
         the command finishes, wait() for the command, or communicate()
         with it.
 
-        Do not use Popen.wait(). Use denova.os.command.wait().
+        Use denova.os.command.wait_child() to wait for the command.
+        Any background processes still running when python exits
+        are polled, so finished ones don't remain as zombies.
 
         >>> program = background('sleep', '0.5')
 
@@ -247,42 +623,54 @@ def background(*command_args, **kwargs):
     if not command_args:
         raise ValueError('missing command')
 
-    _init_log()
+    log = _log()
 
-    command_args = list(map(str, command_args))
+    command_args = _ensure_strs(command_args)
 
-    # if there is a single string arg with a space, it's a command line string
-    if len(command_args) == 1 and isinstance(command_args[0], str) and ' ' in command_args[0]:
-        # run() is better able to add quotes correctly when each arg is separate
+    # a single command line string is only split on request
+    split = kwargs.pop('split', False)
+    if split and len(command_args) == 1:
         command_args = shlex.split(command_args[0])
 
-    kwargs_str = ''
-    for key in kwargs:
-        if kwargs_str:
-            kwargs_str = kwargs_str + ', '
-        kwargs_str = kwargs_str + f'{key}={kwargs[key]}'
+    def log_args(prefix=''):
+        ''' Log the command and kwargs. Only needed on errors. '''
+
+        command_str = ' '.join(command_args)
+        kwargs_str = ', '.join(f'{key}={value}' for key, value in kwargs.items())
+        log.debug(f'{prefix}command: {command_str}')
+        log.debug(f'{prefix}kwargs: {kwargs_str}')
 
     try:
         process = subprocess.Popen(command_args, **kwargs)
+        _enlarge_pipes(process)
 
     except OSError as ose:
-        log.debug(f'os error: command: {command_str}')
-        log.debug(f'os error: kwargs: {kwargs_str}')
+        log_args('os error: ')
         log.exception()
 
         if ose.strerror:
             if 'Exec format error' in ose.strerror:
-                # if the program file starts with '#!' retry with 'shell=True'.
+                # if the program file starts with '#!', run the interpreter
+                # directly instead of starting a shell to do it
                 program_file = command_args[0]
-                with open(program_file) as program:
-                    first_chars = program.read(2)
-                    if str(first_chars) == '#!':
+                # a raw read avoids building a buffered file object
+                fd = os.open(program_file, os.O_RDONLY)
+                try:
+                    # linux also only reads this much of a '#!' line
+                    first_line, _, _ = os.read(fd, SHEBANG_MAX).partition(b'\n')
+                finally:
+                    os.close(fd)
 
-                        process = subprocess.Popen(command_args, shell=True, **kwargs)
+                # like linux, the interpreter may have one arg
+                interpreter = os.fsdecode(first_line[2:]).strip().split(maxsplit=1)
+                if first_line.startswith(b'#!') and interpreter:
 
-                    else:
-                        log.debug(f'no #! in {program_file}')
-                        raise
+                    process = subprocess.Popen([*interpreter, *command_args], **kwargs)
+                    _enlarge_pipes(process)
+
+                else:
+                    log.debug(f'no #! in {program_file}')
+                    raise
 
             else:
                 raise
@@ -291,21 +679,18 @@ def background(*command_args, **kwargs):
             raise
 
     except Exception as e:
-        log.debug(f'command: {command_str}')
-        log.debug(f'kwargs: {kwargs_str}')
+        log_args()
         log.debug(e)
         raise
 
-    else:
-        log.debug(f"background process started: \"{' '.join(process.args)}\", pid: {process.pid}")
-        return process
+    _live_processes.add(process)
+    log.debug(f"background process started: \"{' '.join(process.args)}\", pid: {process.pid}")
+    return process
 
 def get_run_args(*command_args, **kwargs):
     '''
         Get the args in list with each item a string.
 
-        >>> _init_log()
-
         >>> from tempfile import gettempdir
         >>> command_args = ['ls', '-l', gettempdir()]
         >>> kwargs = {}
@@ -320,45 +705,75 @@ def get_run_args(*command_args, **kwargs):
         (['ls', '-l', '/tmp/denova*'], {})
     '''
 
+    log = _log()
+
     if kwargs is None:
         kwargs = {}
 
-    if 'interactive' in kwargs:
-        if kwargs['interactive']:
-            del kwargs['interactive']
-            kwargs.update(dict(stdin=sys.stdin,
-                               stdout=sys.stdout,
-                               stderr=sys.stderr))
-        else:
-            del kwargs['interactive']
+    if kwargs.pop('interactive', False):
+        kwargs.update(dict(stdin=sys.stdin,
+                           stdout=sys.stdout,
+                           stderr=sys.stderr))
 
-    if 'glob' in kwargs:
-        globbing = kwargs['glob']
-        del kwargs['glob']
-    else:
-        globbing = True
+    globbing = kwargs.pop('glob', True)
 
     # subprocess.run() wants strings
-    args = []
-    for arg in command_args:
-        arg = str(arg)
+    command_args = _ensure_strs(command_args)
 
-        # see if the arg contains an inner string so we don't mistake that inner string
-        # containing any wildcard chars. e.g., arg = '"this is an * example"'
-        encased_str = ((arg.startswith('"') and arg.endswith('"')) or
-                       (arg.startswith("'") and arg.endswith("'")))
+    if not globbing:
+        args = list(command_args)
 
-        if ('*' in arg or '?' in arg):
-            if globbing and not encased_str:
-                args.extend(glob(arg))
-                log(f'globbed: {arg}')
+    else:
+        args = []
+        globbed = []
+
+        # local names avoid a lookup per arg
+        append = args.append
+        no_wildcards = _WILDCARDS.isdisjoint
+
+        for arg in command_args:
+
+            # most args have no wildcards, so check that first
+            if no_wildcards(arg):
+                append(arg)
+                continue
+
+            # see if the arg contains an inner string so we don't mistake that inner string
+            # containing any wildcard chars. e.g., arg = '"this is an * example"'
+            encased_str = ((arg.startswith('"') and arg.endswith('"')) or
+                           (arg.startswith("'") and arg.endswith("'")))
+
+            if encased_str:
+                append(arg)
             else:
-                args.append(arg)
-        else:
-            args.append(arg)
+                args.extend(glob(arg))
+                globbed.append(arg)
+
+        if globbed:
+            log(f'globbed: {globbed}')
 
     return args, kwargs
 
+def _ensure_strs(args):
+    ''' Return args as strings.
+
+        Args are almost always strings already, so
+        usually we can skip making a new list.
+
+        >>> args = ('ls', '-l')
+        >>> _ensure_strs(args) is args
+        True
+        >>> _ensure_strs(('sleep', 1))
+        ['sleep', '1']
+    '''
+
+    if all(type(arg) is str for arg in args):
+        result = args
+    else:
+        result = [str(arg) for arg in args]
+
+    return result
+
 def format_output(result):
     '''
         Format the output from a run().
@@ -370,91 +785,64 @@ def format_output(result):
         'Hello'
     '''
 
-    result.stderrout = None
+    stdout = result.stdout
+    stderr = result.stderr
 
-    if result.stderr is not None:
-        if not isinstance(result.stderr, str):
-            result.stderr = result.stderr.decode()
-        result.stderr = result.stderr.strip()
-        result.stderrout = result.stderr
+    # nothing was captured
+    if stdout is None and stderr is None:
+        if not isinstance(result, Result):
+            result.stderrout = None
+        return result
 
-    if result.stdout is not None:
-        if not isinstance(result.stdout, str):
-            result.stdout = result.stdout.decode()
-        result.stdout = result.stdout.strip()
-        if result.stderr:
-            result.stderrout = result.stderr + result.stdout
-        else:
-            result.stderrout = result.stdout
+    # both outputs are bytes, or both are strings
+    if isinstance(stderr if stdout is None else stdout, bytes):
+        if stderr is not None:
+            stderr = stderr.decode()
+        if stdout is not None:
+            stdout = stdout.decode()
+
+    if stderr is not None:
+        stderr = stderr.strip()
+    if stdout is not None:
+        stdout = stdout.strip()
+
+    result.stdout = stdout
+    result.stderr = stderr
+
+    # a Result builds its stderrout only if someone uses it
+    if not isinstance(result, Result):
+        result.stderrout = get_stderrout(result)
 
     # log(f'in format_output() result.stderrout: {result.stderrout}')
     return result
 
+def get_stderrout(result):
+    ''' Return a string combining stderr and stdout from a run(). '''
+
+    if result.stdout is None:
+        stderrout = result.stderr
+    elif result.stderr:
+        stderrout = result.stderr + result.stdout
+    else:
+        stderrout = result.stdout
+
+    return stderrout
+
 def handle_run_error(command_args, cpe):
     '''
-        Handle an error from run().
+        Log an error from run().
+
+        The caller formats the cpe output with format_output() first.
     '''
 
+    log = _log()
+
     command_str = ' '.join(list(map(str, command_args)))
     log(f'command failed. "{command_str}", returncode: {cpe.returncode}')
     log(f'cpe: {cpe}')
     log(f'cpe stderr and stdout: {cpe.stderrout}')
     log(cpe) # DEBUG
 
-    cpe = update_stderrout(cpe)
-
-def update_stderrout(result):
-    ''' Convert stdout and stderrtostrings. Add stderrout. '''
-
-    result.stderrout = None
-
-    if result.stderr is not None:
-        if not isinstance(result.stderr, str):
-            result.stderr = result.stderr.decode()
-        result.stderr = result.stderr.strip()
-        result.stderrout = result.stderr
-
-    if result.stdout is not None:
-        if not isinstance(result.stdout, str):
-            result.stdout = result.stdout.decode()
-        result.stdout = result.stdout.strip()
-        if result.stderr:
-            result.stderrout = result.stderr + result.stdout
-        else:
-            result.stderrout = result.stdout
-
-    return result
-
-
-    """ delete if unused 2021-03-01
-    # old attempts
-    cpe.stderrout = None
-    if cpe.stderr:
-        err = cpe.stderr.decode().strip()
-        log(f'stderr:\n{err}')
-        cpe.stderrout = err
-    if cpe.stdout:
-        out = cpe.stdout.decode().strip()
-        log(f'stdout:\n{out}')
-        if cpe.stderrout is None:
-            cpe.stderrout = out
-        else:
-            cpe.stderrout = cpe.stderrout + '\n' + out
-
-    if cpe.stderr and cpe.stdout:
-        cpe.stderrout = (cpe.stderr.decode().strip() +
-                         '/n' +
-                         cpe.stdout.decode().strip())
-    elif cpe.stderr:
-        cpe.stderrout = cpe.stderr.decode().strip()
-    elif cpe.stdout:
-        cpe.stderrout = cpe.stdout.decode().strip()
-
-    if cpe.stderrout:
-        log(f'cpe stderr and stdout:\n{cpe.stderrout}')
-    """
-
-
 def nice(*args, **kwargs):
     ''' Run a command line at low priority, for both cpu and io.
 
@@ -486,10 +874,13 @@ def nice(*args, **kwargs):
     return run(*args, **kwargs)
 
 def nice_args(*args):
-    ''' Modify command to run at low priority. '''
+    ''' Modify command to run at low priority.
+
+        >>> nice_args('ls', '-l')
+        ('nice', 'nice', 'ionice', '--class', '3', 'ls', '-l')
+    '''
 
-    nice_params = ('nice', 'nice', 'ionice', '--class', '3')
-    return nice_params + args
+    return NICE_PREFIX + args
 
 def wait_child(process):
     ''' Wait for a background process to finish.
@@ -508,50 +899,65 @@ def wait_child(process):
     if not isinstance(process, subprocess.Popen):
         raise ValueError('program must be an instance of subprocess.Popen')
 
-    # options "should be 0 for normal operation"
-    os.waitpid(process.pid, 0)
-
-def _init_log():
-    ''' Initialize log. '''
+    # unlike os.waitpid(), Popen.wait() sets process.returncode,
+    # so the Popen doesn't try to reap the child again later
+    process.wait()
+    _live_processes.discard(process)
 
-    global log
+@atexit.register
+def _reap_background_processes():
+    ''' Reap any finished background processes. '''
 
-    if log is None:
-        # log import delayed to avoid recursive import.
-        from denova.python.log import Log
-        log = Log()
+    for process in list(_live_processes):
+        process.poll()
 
 def show_stderr(*proc_args, **kwargs):
     '''
         How to print program's stderr
         This also handles unicode encoded bytestreams better
 
+        Both pipes are read in one loop with a selector, so
+        neither pipe can fill up and block the program.
+
         Currently unused.
     '''
 
     class CompletedProcessStub:
         pass
 
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
     proc = subprocess.Popen(proc_args,
                             **kwargs)
 
-    # stderr to the console's stdout
-    proc_stderr = ''
-    err_data = proc.stderr.readline()
-    while err_data:
-        line = err_data.decode()
-        proc_stderr = proc_stderr + line
-        # lines already have a newline
-        print(line, end='')
-        err_data = proc.stderr.readline()
-
-    # get any stdout from the proc
-    proc_stdout, _ = proc.communicate()
+    buffers = {}
+    # a read can end in the middle of a multibyte character
+    stderr_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    with selectors.DefaultSelector() as selector:
+        for pipe in [proc.stdout, proc.stderr]:
+            if pipe is not None:
+                os.set_blocking(pipe.fileno(), False)
+                selector.register(pipe, selectors.EVENT_READ)
+                buffers[pipe] = bytearray()
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, PIPE_BUFSIZE)
+                if data:
+                    buffers[key.fileobj].extend(data)
+                    if key.fileobj is proc.stderr:
+                        # stderr to the console's stdout
+                        print(stderr_decoder.decode(data), end='')
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
 
     result = CompletedProcessStub()
     result.resultcode = proc.wait()
-    result.stdout = proc_stdout
-    result.stderr = proc_stderr
+    result.stdout = bytes(buffers.get(proc.stdout, b''))
+    result.stderr = bytes(buffers.get(proc.stderr, b'')).decode(errors='replace')
+
+    return result
 
 
 if __name__ == "__main__":